@@ -1,10 +1,17 @@
 import streamlit as st
 import pandas as pd
 import io
+import os
+import hashlib
+import zipfile
+import numpy as np
+import pyarrow as pa
 import plotly.express as px
 import plotly.graph_objects as go 
 from datetime import timedelta
 
+from kernels import qualified_clients
+
 # --- 1. CONFIGURACIÓN INICIAL DEL DASHBOARD (Streamlit) ---
 st.set_page_config(
     page_title="BI - Diagnóstico de Oferta (Streamlit)", 
@@ -16,11 +23,71 @@ st.set_page_config(
 
 # --- 2. CARGA Y MODELADO DE DATOS (Capa ETL/Model) ---
 
+# Tipos explícitos por archivo fuente: evita re-inferir tipos al parsear el CSV.
+# Los IDs son alfanuméricos (P001, C001...), por eso se guardan como texto y no como int32.
+CSV_DTYPES = {
+    "Ventas": {'VentaID': 'str', 'ClienteID': 'str', 'ProductoID': 'str', 'NegocioID': 'str',
+               'Cantidad': 'Int32', 'ValorVenta': 'float64'},
+    "Clientes": {'ClienteID': 'str', 'Nombre': 'str', 'Ciudad': 'category', 'Segmento': 'category'},
+    "Productos": {'ProductoID': 'str', 'NombreProducto': 'str', 'Categoria': 'category'},
+    "Negocios": {'NegocioID': 'str', 'NombreTienda': 'str'},
+}
+
+def _parquet_path(nombre):
+    """
+    Ruta del Parquet de una tabla. El nombre incluye una firma de su mapa de tipos en
+    CSV_DTYPES, así que un cambio de tipos en el código invalida los Parquet generados antes.
+    """
+    firma = hashlib.sha1(repr(sorted(CSV_DTYPES[nombre].items())).encode()).hexdigest()[:8]
+    return f"{nombre}.{firma}.parquet"
+
+def convert_csv_to_parquet(nombre):
+    """
+    Lee el CSV fuente con tipos explícitos y lo guarda como Parquet (columnar, compresión snappy).
+    Si el Parquet no se puede escribir (p. ej. despliegue de solo lectura), se usa igual el CSV leído.
+    
+    Retorna:
+        - pd.DataFrame: Tabla completa leída del CSV.
+    """
+    df = pd.read_csv(f"{nombre}.csv", dtype=CSV_DTYPES[nombre])
+    if nombre == "Ventas":
+        # La fecha queda almacenada como timestamp lógico en el esquema Parquet
+        df['Fecha'] = pd.to_datetime(df['Fecha'], errors="coerce")
+    
+    parquet_path = _parquet_path(nombre)
+    tmp_path = f"{parquet_path}.tmp"
+    try:
+        # Escritura a un temporal + reemplazo atómico: nunca queda un Parquet a medio escribir
+        df.to_parquet(tmp_path, engine="pyarrow", compression="snappy", index=False)
+        os.replace(tmp_path, parquet_path)
+    except (OSError, pa.ArrowException):
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return df
+
+def load_table(nombre, columns=None):
+    """
+    Carga una tabla fuente desde su Parquet. La conversión desde el CSV solo se hace si el
+    Parquet no existe (para el mapa de tipos actual) o si el CSV es más reciente.
+    
+    Retorna:
+        - pd.DataFrame: Tabla con las columnas solicitadas (todas si columns es None).
+    """
+    csv_path, parquet_path = f"{nombre}.csv", _parquet_path(nombre)
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path):
+        return pd.read_parquet(parquet_path, engine="pyarrow", columns=columns)
+    
+    df = convert_csv_to_parquet(nombre)
+    return df if columns is None else df[columns]
+
 @st.cache_data
 def load_and_model_data():
     """
-    Carga los archivos CSV, realiza la limpieza inicial y ejecuta el modelado de datos 
-    (JOINs) para crear el DataFrame Maestro.
+    Carga los archivos de datos (Parquet generado a partir de los CSV), realiza la limpieza 
+    inicial y ejecuta el modelado de datos (JOINs) para crear el DataFrame Maestro.
     
     Retorna:
         - df_maestro (pd.DataFrame): DataFrame unificado con todas las dimensiones.
@@ -28,38 +95,232 @@ def load_and_model_data():
     """
     try:
         # Rutas relativas simples funcionan en Streamlit Cloud
-        df_ventas = pd.read_csv("Ventas.csv")
-        df_clientes = pd.read_csv("Clientes.csv") 
-        df_productos = pd.read_csv("Productos.csv")
-        df_negocios = pd.read_csv("Negocios.csv")
+        # Solo se materializan las columnas usadas aguas abajo
+        df_ventas = load_table("Ventas", columns=['VentaID', 'ClienteID', 'ProductoID', 'NegocioID', 'Fecha', 'ValorVenta'])
+        df_clientes = load_table("Clientes")
+        df_productos = load_table("Productos", columns=['ProductoID', 'Categoria', 'NombreProducto'])
+        df_negocios = load_table("Negocios", columns=['NegocioID', 'NombreTienda'])
     except FileNotFoundError as e:
         st.error(f"Error: No se encontró el archivo de datos {e}. Asegúrate de que todos los CSV estén en la misma carpeta.")
-        return None, None
+        return None, None, None
+    except (ValueError, TypeError) as e:
+        st.error(f"Error: Un archivo de datos tiene valores que no coinciden con los tipos esperados ({e}). Revisa el contenido de los CSV.")
+        return None, None, None
+
+    # Limpieza: Eliminar ventas sin datos esenciales (p. ej. fechas no parseables, NaT)
+    # antes de los JOINs, para no arrastrarlas por el modelado
+    df_ventas = df_ventas.dropna(subset=['Fecha', 'ClienteID', 'VentaID'])
 
-    # Normalización y Limpieza de Tipos de Datos
-    df_ventas['Fecha'] = pd.to_datetime(df_ventas['Fecha'], errors="coerce")
-    
     # --- MODELADO DE DATOS (JOINs) ---
     
-    # 1. Ventas + Productos: Añadir detalles de Producto
-    df_maestro = pd.merge(df_ventas, df_productos[['ProductoID', 'Categoria', 'NombreProducto']], 
-                         on='ProductoID', how='left')
+    # Dimensiones sin claves duplicadas: garantiza que validate='m:1' no falle con datos sucios
+    df_productos.drop_duplicates('ProductoID', inplace=True)
+    df_clientes.drop_duplicates('ClienteID', inplace=True)
+    df_negocios.drop_duplicates('NegocioID', inplace=True)
+    
+    # Dimensiones indexadas por su ID: cada join es una búsqueda sobre el índice ya construido
+    df_productos_dim = df_productos.set_index('ProductoID')[['Categoria', 'NombreProducto']]
+    df_clientes_dim = df_clientes.set_index('ClienteID')[['Nombre', 'Segmento', 'Ciudad']]
+    df_negocios_dim = df_negocios.set_index('NegocioID')[['NombreTienda']]
+    
+    df_maestro = (
+        df_ventas
+        # 1. Ventas + Productos: Añadir detalles de Producto
+        .join(df_productos_dim, on='ProductoID', how='left', validate='m:1')
+        # 2. Maestro + Clientes: Añadir dimensiones de Cliente (Nombre, Segmento, Ciudad)
+        .join(df_clientes_dim, on='ClienteID', how='left', validate='m:1')
+        # 3. Maestro + Negocios: Añadir nombre de Tienda/Punto de Venta
+        .join(df_negocios_dim, on='NegocioID', how='left', validate='m:1')
+    )
+
+    # Factorización única de claves y dimensiones: los filtros operan sobre códigos enteros
+    # (VentaID es alfanumérico, así que se factoriza en lugar de convertirse a int32)
+    for col in ('VentaID', 'ProductoID', 'ClienteID', 'NegocioID', 'Ciudad', 'Segmento', 'Categoria', 'NombreTienda'):
+        df_maestro[col] = df_maestro[col].astype('category').cat.remove_unused_categories()
+    
+    # ValorVenta se reduce a float32 solo si no hay pérdida de precisión en ninguna suma:
+    # montos enteros (sin centavos) cuya suma absoluta total es < 2**24. Así cualquier suma
+    # parcial es un entero representable exactamente en float32; si no, se mantiene float64
+    valor = df_maestro['ValorVenta']
+    if (valor % 1 == 0).all() and valor.abs().sum() < 2**24:
+        df_maestro = df_maestro.astype({'ValorVenta': 'float32'})
+    
+    # Orden cronológico estable: los filtros de fecha se resuelven con searchsorted sobre un slice
+    df_maestro.sort_values('Fecha', inplace=True, kind='mergesort')
+    df_maestro.reset_index(drop=True, inplace=True)
+    
+    # Contexto descriptivo de cada clave, alineado a sus categorías en df_maestro: la fila i
+    # corresponde al código i, así que la exportación lo adjunta por posición sin merges
+    contextos = {
+        clave: dim.reindex(df_maestro[clave].cat.categories).rename_axis(clave)
+        for clave, dim in (
+            ('ProductoID', df_productos_dim[['NombreProducto']]),
+            ('ClienteID', df_clientes_dim),
+            ('NegocioID', df_negocios_dim),
+        )
+    }
+
+    return df_maestro, df_clientes, contextos
+
+@st.cache_data
+def _filter_options(_df_maestro):
+    """
+    Opciones de los filtros de la barra lateral, leídas de las categorías de df_maestro
+    (una sola vez: el DataFrame no se hashea, es el de la carga).
+    
+    Retorna:
+        - dict: Tuplas ordenadas de productos ("prods"), ciudades ("cities") y segmentos ("segs").
+    """
+    return {
+        "prods": tuple(sorted(_df_maestro['ProductoID'].cat.categories.astype(str))),
+        "cities": tuple(_df_maestro['Ciudad'].cat.categories),
+        "segs": tuple(_df_maestro['Segmento'].cat.categories),
+    }
+
+def _date_window(df_maestro, start_date, end_date):
+    """
+    Posiciones [i0, i1) de las filas con Fecha entre start_date y end_date (ambos inclusive).
+    Requiere df_maestro ordenado por Fecha (ver load_and_model_data).
+    """
+    fechas = df_maestro['Fecha'].values
+    ts_start = pd.Timestamp(start_date).to_datetime64()
+    ts_end = (pd.Timestamp(end_date) + pd.Timedelta(days=1)).to_datetime64() # Fin exclusivo al día siguiente
+    return np.searchsorted(fechas, ts_start, 'left'), np.searchsorted(fechas, ts_end, 'left')
+
+@st.cache_data
+def _prev_client_sums(_df_maestro, offer_codes, compar_start, compar_end):
+    """
+    Venta de los productos de la oferta por cliente en el período comparativo.
+    Solo depende de la oferta y de las fechas comparativas, por lo que no se recalcula
+    al cambiar los filtros ad-hoc ni el umbral (el DataFrame no se hashea: es el de la carga).
+    
+    Retorna:
+        - pd.Series: Venta del período indexada por el código de categoría de ClienteID.
+    """
+    i0, i1 = _date_window(_df_maestro, compar_start, compar_end)
+    v_compar = _df_maestro.iloc[i0:i1]
+    mask_offer = v_compar['ProductoID'].isin(offer_codes).values
     
-    # 2. Maestro + Clientes: Añadir dimensiones de Cliente (Nombre, Segmento, Ciudad)
-    df_maestro = pd.merge(df_maestro, df_clientes[['ClienteID', 'Nombre', 'Segmento', 'Ciudad']], 
-                         on='ClienteID', how='left')
+    v_compar = v_compar.loc[mask_offer]
     
-    # 3. Maestro + Negocios: Añadir nombre de Tienda/Punto de Venta
-    df_maestro = pd.merge(df_maestro, df_negocios[['NegocioID', 'NombreTienda']], 
-                         on='NegocioID', how='left')
-                         
-    # Limpieza final: Eliminar filas sin datos esenciales
-    df_maestro.dropna(subset=['Fecha', 'ClienteID', 'VentaID'], inplace=True)
+    return v_compar['ValorVenta'].groupby(v_compar['ClienteID'].cat.codes, sort=False).sum()
 
-    return df_maestro, df_clientes
+def _attach_contexto(df, contextos, clave):
+    """
+    Añade a df las columnas de contexto de la clave categórica indicada, tomando del
+    contexto precalculado (ver load_and_model_data) la fila de cada código.
+    
+    Retorna:
+        - pd.DataFrame: df con las columnas de contexto a la derecha.
+    """
+    contexto = contextos[clave].iloc[df[clave].cat.codes.to_numpy()].set_axis(df.index)
+    return pd.concat([df, contexto], axis=1)
+
+def _build_report_sheets(df_clientes, contextos, v_period, trans_offer, min_amount, fidelizados):
+    """
+    Construye las hojas del reporte de exportación a partir del período ya filtrado.
+    
+    Retorna:
+        - dict: Nombre de hoja -> DataFrame (la hoja de fidelizados solo si fidelizados no es None).
+    """
+    hojas = {}
+    
+    # Transacciones "Qualifying" (que cumplen el umbral): solo se materializan para el reporte
+    qualifying_trans = trans_offer[trans_offer["VentaOferta"] >= float(min_amount)]
+    
+    # 1. Clientes Qualifiers (Ahora con más contexto de Cliente)
+    # Campos de contexto necesarios: Segmento, Ciudad, Nombre
+    hojas["Clientes_Qualifiers"] = _attach_contexto(
+        qualifying_trans[['ClienteID']].drop_duplicates().reset_index(drop=True), contextos, 'ClienteID'
+    )
+    
+    # 2. Transacciones que Cumplieron el Umbral (Ahora con Tienda y Categoría)
+    # Unir las transacciones que calificaron (qualifying_trans) con el detalle maestro (v_period)
+    trans_detalle = v_period.merge(
+        qualifying_trans[['VentaID', 'VentaOferta']], # Solo las ventas que pasaron el umbral
+        on='VentaID',
+        how='inner'
+    )
+    
+    # Seleccionar y renombrar las columnas relevantes para el análisis transaccional
+    hojas["Transacciones_Umbral"] = trans_detalle[[
+        'VentaID', 'Fecha', 'ClienteID', 'ProductoID', 'NombreProducto', 
+        'Categoria', 'NombreTienda', 'ValorVenta' # ValorVenta es la venta del ítem, no la VentaOferta total
+    ]]
+    
+    # 3. Pareto de Productos (Exporta con Segmento, Ciudad y Tienda)
+    # Se agrega solo por las claves categóricas (Producto, Cliente, Tienda); los atributos
+    # descriptivos dependen de cada clave y se toman por código de los contextos precalculados
+    pareto_full_context = v_period.groupby(['ProductoID', 'ClienteID', 'NegocioID'], sort=False, observed=True)[
+        'ValorVenta'
+    ].sum().rename('VentaTotal').reset_index().sort_values("VentaTotal", ascending=False, ignore_index=True)
+    for clave in ('ProductoID', 'ClienteID', 'NegocioID'):
+        pareto_full_context = _attach_contexto(pareto_full_context, contextos, clave)
+    
+    pareto_columns = [
+        'ProductoID', 'NombreProducto', 'ClienteID', 'Nombre', 
+        'Segmento', 'Ciudad', 'NegocioID', 'NombreTienda'
+    ]
+    # Como la agrupación por las 8 columnas: se excluyen filas con dimensiones sin dato
+    pareto_export = pareto_full_context.dropna(subset=pareto_columns)
+    
+    # % Acumulado sobre las mismas filas que se exportan: venta por código de producto con
+    # bincount, acumulada en orden descendente y devuelta a cada fila por su código
+    codigos_producto = pareto_export['ProductoID'].cat.codes.to_numpy()
+    venta_producto = np.bincount(
+        codigos_producto, weights=pareto_export['VentaTotal'].to_numpy(np.float64),
+        minlength=len(contextos['ProductoID'])
+    )
+    orden = np.argsort(-venta_producto, kind='stable')
+    acumulado = np.empty_like(venta_producto)
+    acumulado[orden] = np.cumsum(venta_producto[orden]) / venta_producto.sum()
+    
+    hojas["Pareto_Detalle_Completo"] = pareto_export[pareto_columns + ['VentaTotal']].assign(
+        **{'%_Acumulado': acumulado[codigos_producto]}
+    )
+    
+    # 4. Clientes Fidelizados (Intersección) - Sin cambios, solo añade contexto
+    if fidelizados is not None:
+        hojas["Clientes_Fidelizados"] = df_clientes[df_clientes['ClienteID'].isin(fidelizados)].merge(
+            contextos['ClienteID'].reset_index(), 
+            on=['ClienteID', 'Nombre', 'Segmento', 'Ciudad'], 
+            how='left'
+        ).drop_duplicates()
+    
+    return hojas
+
+@st.cache_data(show_spinner=False, max_entries=4, ttl=3600)
+def _build_report(report_key, formato, _df_clientes, _contextos, _v_period, _trans_offer, min_amount, _fidelizados):
+    """
+    Genera el archivo de reporte ("xlsx" o "zip" de Parquet). Se invoca de forma diferida
+    desde st.download_button, es decir, solo cuando el usuario descarga. La caché se indexa
+    por report_key (filtros y fechas), así que el mismo archivo se reutiliza entre reruns;
+    solo se conservan los últimos reportes (max_entries) y por una hora como máximo (ttl).
+    
+    Retorna:
+        - bytes: Contenido del archivo a descargar.
+    """
+    hojas = _build_report_sheets(_df_clientes, _contextos, _v_period, _trans_offer, min_amount, _fidelizados)
+    output = io.BytesIO()
+    
+    if formato == "xlsx":
+        # xlsxwriter no mantiene un objeto Cell por celda como openpyxl. El modo constant_memory
+        # no es compatible con to_excel (pandas escribe columna por columna y se perderían datos).
+        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+            for sheet_name, df_hoja in hojas.items():
+                df_hoja.to_excel(writer, index=False, sheet_name=sheet_name)
+    else:
+        # Alternativa liviana: las mismas hojas como archivos Parquet (zstd) dentro de un ZIP
+        with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_STORED) as zf:
+            for sheet_name, df_hoja in hojas.items():
+                buffer_hoja = io.BytesIO()
+                df_hoja.to_parquet(buffer_hoja, engine="pyarrow", compression="zstd", index=False)
+                zf.writestr(f"{sheet_name}.parquet", buffer_hoja.getvalue())
+    
+    return output.getvalue()
 
 # Ejecución de la Carga de Datos
-df_maestro, df_clientes = load_and_model_data()
+df_maestro, df_clientes, contextos = load_and_model_data()
 
 # --- 3. UI/UX: LAYOUT Y FILTROS ---
 
@@ -79,11 +340,11 @@ with st.sidebar:
     st.header("⚙️ Configuración del Análisis")
 
     # 1. Filtro de Producto/Oferta (Ahora con un título más claro)
-    prod_candidates = df_maestro['ProductoID'].astype(str).unique().tolist()
+    opts = _filter_options(df_maestro)
     offer_codes = st.multiselect(
         "1. Códigos de Producto en la Oferta", 
-        options=sorted(prod_candidates), 
-        default=prod_candidates,
+        options=opts["prods"], 
+        default=opts["prods"],
         help="Seleccione los IDs de producto que forman parte de la campaña a analizar."
     )
 
@@ -93,14 +354,14 @@ with st.sidebar:
     # 2. Filtros Adicionales (Segmentación Geográfica y Cliente)
     selected_ciudades = st.multiselect(
         "Filtrar por Ciudad", 
-        options=df_maestro['Ciudad'].dropna().unique(), 
-        default=df_maestro['Ciudad'].dropna().unique()
+        options=opts["cities"], 
+        default=opts["cities"]
     )
 
     selected_segmentos = st.multiselect(
         "Filtrar por Segmento del Cliente", 
-        options=df_maestro['Segmento'].dropna().unique(), 
-        default=df_maestro['Segmento'].dropna().unique()
+        options=opts["segs"], 
+        default=opts["segs"]
     )
     
     st.markdown("---")
@@ -134,33 +395,43 @@ if offer_codes:
     # --- 4. LÓGICA DE FILTRADO Y CÁLCULOS ---
     
     # 1. Filtro Temporal (Período Principal)
-    mask_date = (df_maestro['Fecha'].dt.date >= pd.to_datetime(start_date).date()) & \
-                (df_maestro['Fecha'].dt.date <= pd.to_datetime(end_date).date())
+    # df_maestro está ordenado por Fecha: el período es un slice contiguo (búsqueda binaria)
+    i0, i1 = _date_window(df_maestro, start_date, end_date)
+    v_window = df_maestro.iloc[i0:i1]
     
-    # 2. Filtro de Oferta (Productos Seleccionados)
-    mask_offer = df_maestro['ProductoID'].astype(str).isin([str(x) for x in offer_codes])
+    # 2. Filtro de Oferta (Productos Seleccionados), solo sobre las filas del período
+    mask_offer = v_window['ProductoID'].isin(offer_codes).values
     
     # 3. Filtros Ad-Hoc
-    mask_adhoc_city = df_maestro['Ciudad'].isin(selected_ciudades)
-    mask_adhoc_segment = df_maestro['Segmento'].isin(selected_segmentos)
+    mask_adhoc_city = v_window['Ciudad'].isin(selected_ciudades).values
+    mask_adhoc_segment = v_window['Segmento'].isin(selected_segmentos).values
     
     # DataFrame filtrado para el período principal
-    v_period = df_maestro.loc[mask_date & mask_offer & mask_adhoc_city & mask_adhoc_segment].copy()
+    # Conjunción de las máscaras sobre un único buffer de salida (sin temporales intermedios)
+    mask_period = np.logical_and(mask_offer, mask_adhoc_city)
+    np.logical_and(mask_period, mask_adhoc_segment, out=mask_period)
+    v_period = v_window.loc[mask_period]
 
     
     # CÁLCULOS DE KPIS BÁSICOS Y QUALIFIERS
     
     # 1. Agregación a nivel Transacción: Sumar el monto vendido de la OFERTA por transacción
-    trans_offer = v_period.groupby('VentaID').agg(
-        ClienteID=('ClienteID', "first"),
-        Fecha=('Fecha', "first"),
-        VentaOferta=('ValorVenta', "sum"),
-        ItemsOferta=('ProductoID', "count")
+    # ClienteID y Fecha son invariantes dentro de una VentaID: se toman de la primera fila
+    # en lugar de agregarlos con "first"
+    trans_agg = v_period.groupby('VentaID', sort=False, observed=True)['ValorVenta'].agg(
+        VentaOferta="sum",
+        ItemsOferta="size"
     ).reset_index()
+    trans_heads = v_period[['VentaID', 'ClienteID', 'Fecha']].drop_duplicates('VentaID')
+    trans_offer = trans_heads.merge(trans_agg, on='VentaID', how='left', validate='1:1')
 
-    # 2. Identificación de Transacciones "Qualifying" (que cumplen el umbral)
-    qualifying_trans = trans_offer[trans_offer["VentaOferta"] >= float(min_amount)]
-    total_clients_qual = qualifying_trans['ClienteID'].nunique()
+    # 2. Identificación de Clientes "Qualifying" (con al menos una transacción que cumple el umbral)
+    total_clients_qual, qual_seen = qualified_clients(
+        trans_offer['ClienteID'].cat.codes.to_numpy(),
+        trans_offer['VentaOferta'].to_numpy(np.float64),
+        float(min_amount),
+        len(df_maestro['ClienteID'].cat.categories)
+    )
     
     # KPIs Generales
     venta_total = v_period['ValorVenta'].sum()
@@ -199,26 +470,21 @@ if offer_codes:
         with col_c3:
             compar_min = st.number_input("Umbral Mín. Compar.", value=30000, step=1000, format="%i", help="Monto mínimo para calificar en el período anterior.")
 
-        # Aplicación de filtros comparativos
-        mask_compar = (df_maestro['Fecha'].dt.date >= pd.to_datetime(compar_start).date()) & \
-                      (df_maestro['Fecha'].dt.date <= pd.to_datetime(compar_end).date())
-        
-        v_compar = df_maestro.loc[mask_compar & mask_offer].copy()
+        # Aplicación de filtros comparativos (cacheado: el umbral se aplica fuera de la caché)
+        clients_prev_sum = _prev_client_sums(df_maestro, tuple(offer_codes), compar_start, compar_end)
         
         # Cálculo de clientes Qualifiers en período Previo
-        clients_prev_sum = v_compar.groupby('ClienteID').agg(
-            Venta_Prev=(('ValorVenta', "sum"))
-        ).reset_index()
-        
-        clients_with_prev_qual = clients_prev_sum[clients_prev_sum["Venta_Prev"] >= float(compar_min)]
+        clients_with_prev_qual = clients_prev_sum[clients_prev_sum >= float(compar_min)]
         
         # Intersección: Clientes que cumplen en AMBOS períodos
-        clientes_qual_actual = qualifying_trans['ClienteID'].unique()
-        clientes_qual_previo = clients_with_prev_qual['ClienteID'].unique()
-        fidelizados = set(clientes_qual_actual).intersection(set(clientes_qual_previo))
+        # Se intersectan los códigos enteros de la categoría ClienteID (comparten categorías con df_maestro)
+        clientes_qual_actual = np.flatnonzero(qual_seen)
+        clientes_qual_previo = clients_with_prev_qual.index.values
+        fidelizados_codes = np.intersect1d(clientes_qual_actual, clientes_qual_previo, assume_unique=True)
+        fidelizados = df_maestro['ClienteID'].cat.categories[fidelizados_codes]
         
         # Métricas y Variación
-        venta_compar_total = v_compar['ValorVenta'].sum()
+        venta_compar_total = clients_prev_sum.sum()
         
         if venta_compar_total == 0:
             variacion = "N/A"
@@ -231,7 +497,7 @@ if offer_codes:
         col_f1, col_f2, col_f3 = st.columns(3)
         col_f1.metric("Venta Comparativo", f"${venta_compar_total:,.0f}", variacion)
         col_f2.metric("Clientes Previos Qualifiers", f"{len(clientes_qual_previo):,}")
-        col_f3.metric("🎯 Clientes Fidelizados", f"{len(fidelizados):,}", 
+        col_f3.metric("🎯 Clientes Fidelizados", f"{fidelizados_codes.size:,}", 
                       help="Clientes que cumplen el umbral en AMBOS períodos, demostrando retención.")
 
 
@@ -240,19 +506,24 @@ if offer_codes:
     st.markdown("---")
     st.subheader("📉 Tendencia Diaria de Venta")
     
-    sales_daily = v_period.groupby(v_period['Fecha'].dt.date).agg(VentaTotal=('ValorVenta', 'sum')).reset_index()
-    sales_daily['Fecha'] = pd.to_datetime(sales_daily['Fecha'])
+    # Resample diario sobre datetime64 (sin claves datetime.date); min_count=1 + dropna conserva
+    # solo los días con venta, como antes
+    sales_daily = (
+        v_period.set_index('Fecha')['ValorVenta']
+        .resample('D').sum(min_count=1).dropna()
+        .rename('VentaTotal').reset_index()
+    )
     
     fig_trend = go.Figure()
     
-    # Añadir la línea y texto fijo (solicitud del usuario)
-    fig_trend.add_trace(go.Scatter(
+    # Añadir la línea (el valor diario se muestra en el hover, sin etiquetas de texto por punto)
+    # Con series largas se usa el render WebGL de Plotly
+    scatter_cls = go.Scattergl if len(sales_daily) > 1000 else go.Scatter
+    fig_trend.add_trace(scatter_cls(
         x=sales_daily['Fecha'], 
         y=sales_daily['VentaTotal'], 
-        mode='lines+markers+text', 
+        mode='lines+markers', 
         name='Venta Diaria',
-        text=[f"${v:,.0f}" for v in sales_daily['VentaTotal']], 
-        textposition="top center", 
         line=dict(color='#007BFF', width=3), # Color azul corporativo, línea más gruesa
         marker=dict(size=8, color='#0056B3', line=dict(width=1, color='DarkSlateGrey')), 
         hovertemplate='<b>Fecha:</b> %{x|%Y-%m-%d}<br><b>Venta Total:</b> $%{y:,.0f}<extra></extra>' 
@@ -280,21 +551,23 @@ if offer_codes:
     st.subheader("🥇 Top Productos y Clientes (Principio 80/20)")
     
     # Cálculo del Pareto a nivel de Producto y Cliente (Detalle)
-    pareto_detalle = v_period.groupby(['ProductoID', 'NombreProducto', 'ClienteID', 'Nombre']).agg(
+    pareto_detalle = v_period.groupby(['ProductoID', 'NombreProducto', 'ClienteID', 'Nombre'], sort=False, observed=True).agg(
         VentaTotal=('ValorVenta', "sum")
     ).reset_index().sort_values("VentaTotal", ascending=False)
     
     # Cálculo del Pareto a nivel de Producto (para el % Acumulado)
-    pareto_productos = pareto_detalle.groupby(['ProductoID', 'NombreProducto']).agg(
-        VentaProducto=('VentaTotal', "sum")
-    ).reset_index().sort_values("VentaProducto", ascending=False)
+    # El total por producto se obtiene con transform sobre el detalle (sin un segundo groupby + reset_index)
+    prod_totals = pareto_detalle.groupby('ProductoID', sort=False, observed=True)['VentaTotal'].transform("sum")
+    pareto_productos = pareto_detalle[['ProductoID']].assign(VentaProducto=prod_totals).drop_duplicates(
+        'ProductoID'
+    ).sort_values("VentaProducto", ascending=False)
     
-    pareto_productos["VentaTotal_Cum"] = pareto_productos["VentaProducto"].cumsum()
     total = pareto_productos["VentaProducto"].sum()
-    pareto_productos["%_Acumulado"] = pareto_productos["VentaTotal_Cum"] / total
+    pareto_productos["%_Acumulado"] = pareto_productos["VentaProducto"].cumsum() / total
     
     # Unión y Display
-    pareto_df = pd.merge(pareto_detalle, pareto_productos[['ProductoID', '%_Acumulado']], on='ProductoID', how='left')
+    pareto_df = pd.merge(pareto_detalle, pareto_productos[['ProductoID', '%_Acumulado']], 
+                         on='ProductoID', how='left', validate='m:1')
     
     # Filtramos para el 80% y preparamos las columnas para el display
     pareto_display = pareto_df[pareto_df["%_Acumulado"] <= 0.8].rename(
@@ -331,77 +604,29 @@ if offer_codes:
     st.markdown("---")
     st.subheader("📥 Exportación de Resultados para Análisis Adicional")
     
-    # Crear un buffer en memoria para el archivo Excel
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        
-        # 1. Clientes Qualifiers (Ahora con más contexto de Cliente)
-        # Campos de contexto necesarios: Segmento, Ciudad, Nombre
-        cliente_contexto = df_maestro[['ClienteID', 'Nombre', 'Segmento', 'Ciudad']].drop_duplicates()
-        qualifying_clients = qualifying_trans[['ClienteID']].drop_duplicates().merge(
-            cliente_contexto, 
-            on='ClienteID', 
-            how='left'
+    # El reporte solo se construye al hacer clic (data diferida, requiere streamlit>=1.52) y se cachea por filtros y fechas
+    report_key = (tuple(offer_codes), tuple(selected_ciudades), tuple(selected_segmentos), 
+                  start_date, end_date, min_amount)
+    if use_compar:
+        report_key += (compar_start, compar_end, compar_min)
+    report_args = (df_clientes, contextos, v_period, trans_offer, min_amount, fidelizados if use_compar else None)
+    
+    col_d1, col_d2 = st.columns(2)
+    with col_d1:
+        st.download_button(
+            "💾 Descargar Reporte Completo (Excel)", 
+            data=lambda: _build_report(report_key, "xlsx", *report_args), 
+            file_name=f"diagnostico_oferta_{start_date}_a_{end_date}.xlsx", 
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
-        qualifying_clients.to_excel(writer, index=False, sheet_name="Clientes_Qualifiers")
-        
-        # 2. Transacciones que Cumplieron el Umbral (Ahora con Tienda y Categoría)
-        # Unir las transacciones que calificaron (qualifying_trans) con el detalle maestro (v_period)
-        trans_detalle = v_period.merge(
-            qualifying_trans[['VentaID', 'VentaOferta']], # Solo las ventas que pasaron el umbral
-            on='VentaID',
-            how='inner'
+    with col_d2:
+        st.download_button(
+            "🗜️ Descargar Reporte (Parquet ZIP)", 
+            data=lambda: _build_report(report_key, "zip", *report_args), 
+            file_name=f"diagnostico_oferta_{start_date}_a_{end_date}.zip", 
+            mime="application/zip",
+            help="Mismas hojas en formato Parquet: archivo mucho más liviano, ideal para pandas/Power BI."
         )
-        
-        # Seleccionar y renombrar las columnas relevantes para el análisis transaccional
-        trans_export = trans_detalle[[
-            'VentaID', 'Fecha', 'ClienteID', 'ProductoID', 'NombreProducto', 
-            'Categoria', 'NombreTienda', 'ValorVenta' # ValorVenta es la venta del ítem, no la VentaOferta total
-        ]]
-        
-        # Exportar
-        trans_export.to_excel(writer, index=False, sheet_name="Transacciones_Umbral")
-        
-        # 3. Pareto de Productos (Exporta con Segmento, Ciudad y Tienda)
-        # Unir el Pareto calculado con las dimensiones de Tienda (NegocioID) y Cliente (Segmento, Ciudad)
-        pareto_full_context = v_period.groupby([
-            'ProductoID', 'NombreProducto', 'ClienteID', 'Nombre', 
-            'Segmento', 'Ciudad', 'NegocioID', 'NombreTienda'
-        ]).agg(
-            VentaTotal=('ValorVenta', "sum")
-        ).reset_index().sort_values("VentaTotal", ascending=False)
-        
-        # Calcular el % Acumulado nuevamente sobre el nuevo detalle
-        pareto_productos_venta = pareto_full_context.groupby(['ProductoID', 'NombreProducto']).agg(
-            VentaProducto=('VentaTotal', "sum")
-        ).reset_index().sort_values("VentaProducto", ascending=False)
-        
-        pareto_productos_venta["VentaTotal_Cum"] = pareto_productos_venta["VentaProducto"].cumsum()
-        total_venta_oferta = pareto_productos_venta["VentaProducto"].sum()
-        pareto_productos_venta["%_Acumulado"] = pareto_productos_venta["VentaTotal_Cum"] / total_venta_oferta
-        
-        # Unir para obtener el % Acumulado en el detalle final
-        pareto_export = pd.merge(pareto_full_context, pareto_productos_venta[['ProductoID', '%_Acumulado']], on='ProductoID', how='left')
-        
-        # Exportar el detalle completo de Pareto
-        pareto_export.to_excel(writer, index=False, sheet_name="Pareto_Detalle_Completo")
-        
-        # 4. Clientes Fidelizados (Intersección) - Sin cambios, solo añade contexto
-        if use_compar:
-            df_fidelizados_contexto = df_clientes[df_clientes['ClienteID'].isin(fidelizados)].merge(
-                cliente_contexto, 
-                on=['ClienteID', 'Nombre', 'Segmento', 'Ciudad'], 
-                how='left'
-            ).drop_duplicates()
-            
-            df_fidelizados_contexto.to_excel(writer, index=False, sheet_name="Clientes_Fidelizados")
-            
-    st.download_button(
-        "💾 Descargar Reporte Completo (Excel)", 
-        data=output.getvalue(), 
-        file_name=f"diagnostico_oferta_{start_date}_a_{end_date}.xlsx", 
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
 
 else:
     st.info("💡 Por favor, selecciona al menos un producto en la sección 'Códigos de Producto en la Oferta' en la barra lateral izquierda para comenzar el análisis.")
@@ -0,0 +1,27 @@
+"""
+Kernels numéricos compilados con Numba para el dashboard (app.py).
+
+Viven en un módulo aparte porque Streamlit re-ejecuta app.py en cada interacción, pero
+conserva los módulos importados: así la función compilada sobrevive entre reruns.
+"""
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def qualified_clients(codes, vals, thr, ncat):
+    """
+    Clientes con al menos una transacción >= thr, en una sola pasada sin máscaras temporales.
+    
+    Retorna:
+        - int: Número de clientes qualifiers.
+        - np.ndarray: Máscara (uint8) sobre los códigos de categoría de ClienteID.
+    """
+    seen = np.zeros(ncat, np.uint8)
+    n = 0
+    for i in range(codes.size):
+        c = codes[i]
+        if vals[i] >= thr and not seen[c]:
+            seen[c] = 1
+            n += 1
+    return n, seen